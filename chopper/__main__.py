@@ -3,7 +3,8 @@ from chopper import chopper
 
 
 def main():
-    pass
+    chopper.main()
 
 
-chopper.main()
+if __name__ == '__main__':
+    main()
@@ -2,49 +2,128 @@
 
 from datetime import datetime
 import os
+import stat
 import sys
 import errno
 import io
+import mmap
 import argparse
+import re
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from functools import partial
+from itertools import groupby, islice, chain
+from collections import deque
+from operator import itemgetter
 from textwrap import dedent
 from pprint import pprint as pp
-from html.parser import HTMLParser
+from html import unescape
 from pathlib import Path
 from enum import Enum
 import difflib
-from typing import List, Any, Dict, Union
+from typing import List, Any, Dict, Union, Iterator, Iterable, Callable
 
 NOW = datetime.now().isoformat(timespec='seconds', sep=',')
-DRYRUN = False
 CHOPPER_NAME = '.chopper.html'
+# Directories that never hold chopper files and aren't walked into.
+SKIP_DIRS: frozenset[str] = frozenset({'.git', 'node_modules'})
+CHUNK_SIZE = 65536
+WRITE_BUF = 256 * 1024
+MAGIC_VAR_RE = re.compile(r'\{\{|\}\}|\{([^{}]*)\}')
+
+TAGS: frozenset[str] = frozenset({'style', 'script', 'chop'})
+RAW_TEXT_TAGS: frozenset[str] = frozenset({'style', 'script'})
+
+# The tokens ChopperParser looks for: comments, so the tags in them can
+# be skipped, and the start and end tags of the chopper tags.  Quoted
+# attribute values may contain '>', a start tag ending in '/>' closes
+# itself.
+TAG_NAMES = '|'.join(sorted(TAGS)).encode()
+# As in ATTR_RE, a quote only starts a value straight after '='.  Every
+# character in a start tag has one way to match, and a comment or start
+# tag that is never closed runs to the end of the data, so a malformed
+# tag is scanned once rather than again for every tag after it.
+TAG_RE = re.compile(
+    rb'<!--.*?(?:-->|\Z)'
+    rb'|<(?P<start>' + TAG_NAMES + rb')(?=[\s/>])'
+    rb'(?P<attrs>(?:[^>=]|=\s*(?:"[^"]*"|\'[^\']*\'|(?![\'"])[^\s>]*)|=)*?)'
+    rb'(?:(?P<close>/?)>|\Z)'
+    rb'|</\s*(?P<end>' + TAG_NAMES + rb')\s*>',
+    re.IGNORECASE | re.DOTALL,
+)
+RAW_TEXT_END_RE = {
+    tag: re.compile(rb'</\s*' + tag.encode() + rb'\s*>', re.IGNORECASE)
+    for tag in RAW_TEXT_TAGS
+}
+# A start tag's attributes as name and value pairs, split the same way
+# as html.parser does it.
+ATTR_RE = re.compile(
+    rb'([^\s/>][^\s/=>]*)'
+    rb'(?:\s*=+\s*(?:"([^"]*)"|\'([^\']*)\'|(?![\'"])([^>\s]*)))?'
+)
+MAX_DIFF_LINES = 500
+MAX_DIFF_SIZE = 1_000_000
+# Each worker is a process that is started up front, a few are enough to
+# keep the disk busy.
+MAX_WORKERS = min(os.cpu_count() or 1, 4)
+
+# Destination directories that have already been created.
+DIRS_MADE: set = set()
+
+# Output collected while files are chopped in worker processes.
+OUTPUT = threading.local()
+
+# Held while a destination is written.  Worker processes share one lock,
+# so sources with the same destination can't interleave their writes.
+WRITE_LOCK: Any = nullcontext()
+
+# Colours are left out when the output is piped or NO_COLOR is set.
+COLOR: bool = sys.stdout.isatty() and not os.environ.get('NO_COLOR')
+
+
+def ansi(code: int) -> str:
+    """Return the escape sequence for an ANSI style code, if colours are on."""
+    return f'\033[{code}m' if COLOR else ''
 
 
 class C:
-    MAGENTA = '\033[95m'
+    MAGENTA = ansi(95)
 
-    RED = '\033[31m'
-    BRED = '\033[91m'
-    REDB = '\033[41m'
+    RED = ansi(31)
+    BRED = ansi(91)
+    REDB = ansi(41)
 
-    BLUE = '\033[34m'
-    BBLUE = '\033[94m'
-    BLUEB = '\033[44m'
+    BLUE = ansi(34)
+    BBLUE = ansi(94)
+    BLUEB = ansi(44)
 
-    BCYAN = '\033[96m'
-    CYAN = '\033[36m'
-    CYANB = '\033[46m'
+    BCYAN = ansi(96)
+    CYAN = ansi(36)
+    CYANB = ansi(46)
 
-    GREEN = '\033[32m'
-    BGREEN = '\033[92m'
-    GREENB = '\033[42m'
+    GREEN = ansi(32)
+    BGREEN = ansi(92)
+    GREENB = ansi(42)
 
-    BLACK = '\033[30m'
-    BBLACK = '\033[90m'
-    BLACKB = '\033[40m'
+    BLACK = ansi(30)
+    BBLACK = ansi(90)
+    BLACKB = ansi(40)
 
-    BOLD = '\033[1m'
-    UNDERLINE = '\033[4m'
-    RESET = '\033[0m'
+    BOLD = ansi(1)
+    UNDERLINE = ansi(4)
+    RESET = ansi(0)
+
+
+# Formats for the context diff lines, keyed on the line prefix.  The
+# '****' hunk separator is checked before the two character prefixes.
+# Changed lines ('! ') and anything else are printed as is.
+DIFF_STYLES: Dict[str, str] = {
+    '****': f'\n{C.BCYAN}{"=" * 80}{C.RESET}\n',
+    '--': f'{C.BLACK}{C.REDB}{{}}{C.RESET}',
+    '**': f'{C.BLACK}{C.GREENB}{{}}{C.RESET}',
+}
 
 
 class Action(Enum):
@@ -54,6 +133,52 @@ class Action(Enum):
     DIR = 'Mkdir'
     UNCHANGED = 'File unchanged'
     DOESNOTEXIST = 'Does not exist'
+    UPTODATE = 'Up to date'
+
+
+# The coloured parts of the messages that don't change between calls.
+CHOPPA: str = f'{C.MAGENTA}{C.BOLD}CHOPPER:{C.RESET}'
+ERROR_CHOPPA: str = f'{C.REDB}{C.BOLD}CHOPPER:{C.RESET}'
+CHOP_DATE: str = f'{C.BBLACK}{NOW}{C.RESET}'
+DRY_RUN_SUFFIXES: Dict[bool, str] = {False: '', True: ' (DRY RUN)'}
+INFO_LABELS: Dict[tuple, str] = {
+    (action, dry_run): f'{C.BGREEN}{action.value}{suffix}{C.RESET}'
+    for action in Action
+    for dry_run, suffix in DRY_RUN_SUFFIXES.items()
+}
+ERROR_LABELS: Dict[tuple, str] = {
+    (action, dry_run): f'{C.REDB}{C.BOLD}{action.value}{suffix}{C.RESET}'
+    for action in Action
+    for dry_run, suffix in DRY_RUN_SUFFIXES.items()
+}
+
+
+def echo(*args, file=None) -> None:
+    """Print the args, or save them if the thread is collecting its output."""
+    buffer = getattr(OUTPUT, 'buffer', None)
+    if buffer is None:
+        print(*args, file=file)
+    else:
+        stream = 'stderr' if file is sys.stderr else 'stdout'
+        buffer.append((stream, ' '.join(map(str, args)) + '\n'))
+
+
+def write_output(output: list) -> None:
+    """Write saved output with one write per run of lines to the same stream.
+
+    The text is encoded in one go and written straight to the stream's
+    binary buffer when it has one."""
+    for name, lines in groupby(output, key=itemgetter(0)):
+        stream = getattr(sys, name)
+        text = ''.join(text for _, text in lines)
+        binary = getattr(stream, 'buffer', None)
+        if binary is None:
+            stream.write(text)
+            stream.flush()
+        else:
+            stream.flush()
+            binary.write(text.encode(stream.encoding, stream.errors))
+            binary.flush()
 
 
 def info(
@@ -62,256 +187,563 @@ def info(
     dry_run: bool = False,
     last: bool = False,
 ) -> None:
-    dry_run = ' (DRY RUN)' if dry_run else ''
-    choppa: str = f'{C.MAGENTA}{C.BOLD}CHOPPER:{C.RESET}'
-    task: str = f'{C.BGREEN}{action.value}{dry_run}{C.RESET}'
-    filename: str = f'{C.BBLUE}{filename}{C.RESET}'
-    tree: str = ''
-    if action != action.CHOP:
-        tree = '└─ ' if last else '├─ '
-    date: str = ''
-    if action == action.CHOP:
-        date = f'{C.BBLACK}{NOW}{C.RESET}'
-    print(f'{choppa} {tree}{task} {filename}  {date}')
+    task: str = INFO_LABELS[action, dry_run]
+    if action == Action.CHOP:
+        echo(f'{CHOPPA} {task} {C.BBLUE}{filename}{C.RESET}  {CHOP_DATE}')
+    else:
+        tree: str = '└─ ' if last else '├─ '
+        echo(f'{CHOPPA} {tree}{task} {C.BBLUE}{filename}{C.RESET}  ')
 
 
 def error(action: Action, filename: str, msg: str, dry_run: bool = False) -> None:
-    dry_run = ' (DRY RUN)' if dry_run else ''
-    choppa: str = f'{C.REDB}{C.BOLD}CHOPPER:{C.RESET}'
-    action: str = f'{C.REDB}{C.BOLD}{action.value}{dry_run}{C.RESET}'
-    filename: str = f'{C.BBLUE}{filename}{C.RESET}'
-    print(choppa, action, msg, filename, file=sys.stderr)
-
-
-class ChopperParser(HTMLParser):
-    tags: list[str] = ['style', 'script', 'chop']
-    tree: list[Any] = []
-    path: str = None
-    parsed_data: list[dict[str, Any]] = []
-    start: tuple = None
-
-    def handle_starttag(self, tag, attrs):
-        if tag in self.tags:
-            self.tree.append(tag)
-            for attr in attrs:
-                if attr[0] == 'chopper:file':
-                    self.path = attr[1]
-                    pos = list(self.getpos())
-                    pos[0] = pos[0] - 1
-                    extra = [len(i) for i in self.get_starttag_text().split("\n")]
-                    for line in extra:
-                        pos = (pos[0] + 1, line)
-                    self.start = pos
-
-    def handle_endtag(self, tag):
-        if tag in self.tags:
+    label: str = ERROR_LABELS[action, dry_run]
+    echo(ERROR_CHOPPA, label, msg, f'{C.BBLUE}{filename}{C.RESET}', file=sys.stderr)
+
+
+class Block:
+    """A block of code from a chopper file and where it is to be written."""
+
+    __slots__ = (
+        'path',
+        'tag',
+        'start',
+        'end',
+        'content',
+        'base_path',
+        'dest',
+        'source_file',
+        'comment_open',
+        'comment_close',
+    )
+
+    def __init__(self, path: str, tag: str, start: int, end: int):
+        self.path: str = path
+        self.tag: str = tag
+        self.start: int = start
+        self.end: int = end
+        self.content: str = ''
+        self.base_path: str = ''
+        self.dest: str = ''
+        self.source_file: str = ''
+        self.comment_open: str = ''
+        self.comment_close: str = ''
+
+
+class ChopperParser:
+    """Find the top level chopper blocks in the source with a regex sweep.
+
+    Only the chopper tags are looked at.  Like an HTML parser, tags in
+    comments are ignored and the contents of script and style tags are
+    skipped up to their end tag.  Block positions are offsets into the
+    source."""
+
+    def __init__(self, on_block=None):
+        """on_block is called with each top level block as soon as its end
+        tag is found, by default the blocks are kept in parsed_data."""
+        self.tree: list[Any] = []
+        self.path: str = ''
+        self.parsed_data: list[Block] = []
+        self.start: int = None
+        self.on_block = on_block or self.parsed_data.append
+
+    def parse(self, source: Union[bytes, mmap.mmap]) -> None:
+        pos: int = 0
+        while match := TAG_RE.search(source, pos):
+            pos = match.end()
+            if match.group('start'):
+                if match.group('close') is None:
+                    # The start tag is never closed, the rest is text.
+                    break
+                tag = match.group('start').decode().lower()
+                self.handle_starttag(tag, match.group('attrs'), match.end())
+                if match.group('close'):
+                    # Self closing, there is no content or end tag.
+                    self.handle_endtag(tag, match.end())
+                elif tag in RAW_TEXT_TAGS:
+                    match = RAW_TEXT_END_RE[tag].search(source, pos)
+                    if not match:
+                        break
+                    pos = match.end()
+                    self.handle_endtag(tag, match.start())
+            elif match.group('end'):
+                self.handle_endtag(match.group('end').decode().lower(), match.start())
+
+    def handle_starttag(self, tag: str, attrs: bytes, end: int) -> None:
+        self.tree.append(tag)
+        for name, *values in ATTR_RE.findall(attrs):
+            # Like html.parser, a repeated attribute's last value wins.
+            if name.lower() == b'chopper:file':
+                value = b''.join(values)
+                self.path = unescape(value.decode())
+                # The block starts where the start tag ends.
+                self.start = end
+
+    def handle_endtag(self, tag: str, start: int) -> None:
+        if self.tree:
             self.tree.pop()
             if not self.tree:
-                self.parsed_data.append(
-                    {
-                        'path': self.path,
-                        'tag': tag,
-                        'start': self.start,
-                        'end': self.getpos(),
-                    }
-                )
+                self.on_block(Block(self.path, tag, self.start, start))
                 self.path = ''
 
 
-def find_chopper_files(source: Path) -> list[str]:
-    """Find all the chopper files in the source directory."""
-    if not os.path.exists(source):
-        raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), source)
+def find_chopper_files(source: Path) -> Iterator[str]:
+    """Find all the chopper files in the source directory.
 
-    if not os.path.isdir(source):
+    The source is checked straight away, the files are found lazily as
+    they are iterated over."""
+    if not stat.S_ISDIR(os.stat(source).st_mode):
         raise NotADirectoryError(errno.ENOTDIR, os.strerror(errno.ENOTDIR), source)
 
-    chopper_files = []
-
-    for root, dirs, files in os.walk(source):
-        for filename in files:
-            if filename.endswith(CHOPPER_NAME):
-                chopper_files.append(os.path.join(root, filename))
+    return scan_dir(source)
 
-    return chopper_files
 
+def scan_dir(path: Union[str, Path]) -> Iterator[str]:
+    """Yield the chopper files in path, recursing into sub directories.
 
-def chop(source, types, insert_comments, comments, warn=False):
-    """Chop up the source file into the blocks defined by the chopper tags."""
+    Files in a directory are yielded before its sub directories are
+    walked and symlinked directories are not followed, the same order
+    and rules that os.walk uses.  Directories in SKIP_DIRS are pruned."""
+    subdirs: list[str] = []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    if not entry.is_symlink() and entry.name not in SKIP_DIRS:
+                        subdirs.append(entry.path)
+                elif entry.name.endswith(CHOPPER_NAME):
+                    yield entry.path
+    except OSError:
+        return
+
+    for subdir in subdirs:
+        yield from scan_dir(subdir)
+
+
+def chop(
+    source, types, insert_comments, comments, warn=False, newer=False, dry_run=False
+):
+    """Chop up the source file into the blocks defined by the chopper tags.
+
+    Blocks are written as soon as they are parsed.  Each one is held back
+    until the next is found so the last block in the file is known.
+
+    If newer is set and every destination is newer than the source, the
+    source is skipped.  Otherwise destinations that are unchanged are
+    touched, so they count as newer on the next run.  Nothing is written
+    if dry_run is set."""
     info(Action.CHOP, source)
-    with open(source, 'r') as f:
-        source_html = f.read()
+    if newer and not warn and is_up_to_date(source, types):
+        info(Action.UPTODATE, source, last=True)
+        return True
 
-    parser = ChopperParser()
-    parser.parsed_data.clear()
-    parser.feed(source_html)
-    data = parser.parsed_data
+    results: list[bool] = []
+    pending: list[Block] = []
+    expand = magic_vars(source)
+    touch: bool = newer and not warn
 
-    source_html = source_html.splitlines()
-    block_count = len(data) - 1
-    success: bool = True
-    for i, block in enumerate(data):
-        block['base_path'] = types[block['tag']]
-        block['path'] = magic_vars(block['path'], source)
-        block['content'] = extract_block(block['start'], block['end'], source_html)
-        block['source_file'] = source
-
-        c = comments[block['tag']]
-        block['comment_open'], block['comment_close'] = c
-        if insert_comments:
-            # text = [source, block['path']]
-            dest = Path(os.path.join(block['base_path'], block['path']))
-            comment = f'{c[0]}{source} -> {dest}{c[1]}'
-            block['content'] = f'\n{comment}\n\n{block["content"]}'
-
-        last = False if block_count != i else True
-        if not new_or_overwrite_file(block, warn, last):
-            success = False
+    with open(source, 'rb') as f:
+        if not os.fstat(f.fileno()).st_size:
+            return True
 
-    return success
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as source_html:
+
+            def write_pending(last):
+                block = pending.pop()
+                args = (source, types, insert_comments, comments, warn, last)
+                results.append(write_block(block, *args, dry_run, touch))
+
+            def on_block(block):
+                if pending:
+                    write_pending(False)
+                block.path = expand(block.path)
+                if block.path and needs_content(block, types, warn, dry_run):
+                    block.content = extract_block(block.start, block.end, source_html)
+                pending.append(block)
+
+            ChopperParser(on_block=on_block).parse(source_html)
+            if pending:
+                write_pending(True)
+
+    return all(results)
+
+
+def needs_content(block, types, warn, dry_run) -> bool:
+    """Check if the block's content is used when writing it.
+
+    A dry run only compares the content with existing files, new files are
+    reported without it."""
+    if warn or not dry_run:
+        return True
+    return os.path.exists(dest_path(types[block.tag], block.path))
 
 
-def extract_block(start: List, end: List, source_html: List) -> str:
+def is_up_to_date(source, types) -> bool:
+    """Check if all the source's destination files are newer than it."""
+    blocks: list[Block] = []
+    with open(source, 'rb') as f:
+        ChopperParser(on_block=blocks.append).parse(f.read())
+
+    source_mtime = os.stat(source).st_mtime
+    expand = magic_vars(source)
+    for block in blocks:
+        path = expand(block.path)
+        if not path:
+            continue
+        try:
+            dest_mtime = os.stat(dest_path(types[block.tag], path)).st_mtime
+        except OSError:
+            return False
+        if dest_mtime < source_mtime:
+            return False
+
+    return True
+
+
+def write_block(
+    block, source, types, insert_comments, comments, warn, last, dry_run, touch=False
+):
+    """Work out where the block goes and write it there.
+
+    The magic variables in the block's path have already been replaced."""
+    block.base_path = types[block.tag]
+    block.dest = dest_path(block.base_path, block.path)
+    block.source_file = source
+
+    c_open, c_close = block.comment_open, block.comment_close = comments[block.tag]
+    if insert_comments:
+        # text = [source, block.path]
+        comment = f'{c_open}{source} -> {Path(block.dest)}{c_close}'
+        block.content = f'\n{comment}\n\n{block.content}'
+
+    return new_or_overwrite_file(block, warn, last, dry_run, touch)
+
+
+def dir_prefix(path: str) -> str:
+    """Return the directory with a trailing separator, ready to prefix file names."""
+    return os.path.join(path, '') if path else ''
+
+
+def dest_path(prefix: str, path: str) -> str:
+    """Join a destination path onto a directory prefix from dir_prefix().
+
+    Like os.path.join, an absolute path replaces the prefix."""
+    return path if os.path.isabs(path) else prefix + path
+
+
+def buffered_chop(*args, **kwargs):
+    """Run chop() saving its output instead of printing it.
+
+    Return chop's result, the saved output and the exit or error if chop()
+    exits or fails, so files chopped in parallel can still be reported one
+    after another and the output of a file that fails isn't lost."""
+    OUTPUT.buffer = buffer = []
+    try:
+        return chop(*args, **kwargs), buffer, None
+    except (SystemExit, Exception) as e:
+        return False, buffer, e
+    finally:
+        OUTPUT.buffer = None
+
+
+def map_sources(
+    fn, sources: Iterable[str], stop: Callable[[Any], bool] = lambda result: False
+) -> Iterator:
+    """Map fn over the sources in order, in worker processes if there are
+    several of them.
+
+    Sources are pulled from the iterable as workers free up, so finding
+    the files overlaps with chopping them.  Once stop returns true for a
+    result, the sources that haven't started are cancelled and only the
+    results of those already running follow."""
+    sources = iter(sources)
+    first: list[str] = list(islice(sources, MAX_WORKERS))
+    if len(first) < 2:
+        for result in map(fn, chain(first, sources)):
+            yield result
+            if stop(result):
+                return
+        return
+
+    workers: int = len(first)
+    lock = multiprocessing.Lock()
+    with ProcessPoolExecutor(
+        workers, initializer=set_write_lock, initargs=(lock,)
+    ) as executor:
+        pending: deque = deque()
+        stopped: bool = False
+        for source in chain(first, sources):
+            pending.append(executor.submit(fn, source))
+            if len(pending) >= workers * 2:
+                result = pending.popleft().result()
+                yield result
+                if stop(result):
+                    stopped = True
+                    break
+        while pending:
+            if stopped:
+                for future in pending:
+                    future.cancel()
+            future = pending.popleft()
+            if not future.cancelled():
+                result = future.result()
+                yield result
+                stopped = stopped or stop(result)
+
+
+def set_write_lock(lock) -> None:
+    """Use the pool's shared lock for writes in this worker process."""
+    global WRITE_LOCK
+    WRITE_LOCK = lock
+
+
+def extract_block(start: int, end: int, source_html: mmap.mmap) -> str:
     """Extract the block of code from the source.
 
     Extract from the end of the start tag to the start of the end tag."""
 
-    start_line: int = start[0] - 1
-    start_char: int = start[1]
-    end_line: int = end[0]
-    end_char: int = end[1]
+    text: str = source_html[start:end].decode('utf-8').replace('\r\n', '\n')
 
-    extracted: array = source_html[start_line:end_line]
-    if len(extracted) == 1:
-        extracted[0] = extracted[0][start_char:end_char]
-    else:
-        extracted[0] = extracted[0][start_char:]
-        extracted[-1] = extracted[-1][:end_char]
-
-    extracted = '\n'.join(extracted)
-    extracted = dedent(extracted)
+    extracted = '\n'.join(dedent_lines(text.split('\n')))
     extracted = extracted.strip()
     extracted = f'{extracted}\n'
 
     return extracted
 
 
-def magic_vars(path, source):
-    """Replace magic variables in the path with the source file name.
+def dedent_lines(lines: List[str]) -> List[str]:
+    """Remove the common leading whitespace from the lines.
+
+    Behaves like textwrap.dedent but works on lines that are already
+    split and uses plain string operations instead of regexes.  Lines
+    that only contain spaces and tabs are emptied and don't count
+    towards the margin."""
+
+    margin: str = None
+    for line in lines:
+        stripped = line.lstrip(' \t')
+        if not stripped:
+            continue
+        indent = line[: len(line) - len(stripped)]
+        if margin is None:
+            margin = indent
+        elif not indent.startswith(margin):
+            margin = os.path.commonprefix([margin, indent])
+        if not margin:
+            break
+
+    cut: int = len(margin) if margin else 0
+    return [line[cut:] if line.lstrip(' \t') else '' for line in lines]
+
+
+def magic_vars(source) -> Callable[[str], str]:
+    """Return a function that replaces the magic variables in a path.
 
     If the source file is named `hero.chopper.html` and the chopper:file
-    attribute is `assets/{NAME}.css`, return the string `assets/hero.css`.
+    attribute is `assets/{NAME}.css`, the function returns the string
+    `assets/hero.css`.  The values only depend on the source, so they
+    are worked out once for all of its blocks.
     """
-    source = Path(source)
-    source_name = source.name.replace(CHOPPER_NAME, '')
+    source = str(Path(source))
     fields = {
-        'NAME': source_name,
+        'NAME': os.path.basename(source).replace(CHOPPER_NAME, ''),
         'THIS-NAME': source,
     }
-    try:
-        new_name = path.format(**fields)
-    except KeyError:
-        error(Action.CHOP, str(source), 'Invalid magic variable in attribute:')
-        sys.exit(1)
-    return new_name
-
 
-def new_or_overwrite_file(block, warn=False, last=False):
-    """Create or update the file specified in the chopper:file attribute."""
-    content = f'{block["content"]}'
+    def replace(match):
+        var = match.group(1)
+        if var is None:
+            # An escaped '{{' or '}}'.
+            return match.group(0)[0]
+        try:
+            return fields[var]
+        except KeyError:
+            error(Action.CHOP, source, 'Invalid magic variable in attribute:')
+            sys.exit(1)
+
+    def expand(path: str) -> str:
+        if '{' not in path and '}' not in path:
+            # Most paths have no variables or escapes to replace.
+            return path
+        return MAGIC_VAR_RE.sub(replace, path)
+
+    return expand
+
+
+def new_or_overwrite_file(block, warn=False, last=False, dry_run=False, touch=False):
+    """Create or update the file specified in the chopper:file attribute.
+
+    If touch is set, a file whose contents are unchanged gets its
+    modification time updated."""
+    content = block.content.encode('utf-8')
+    if os.linesep != '\n':
+        # Files are written with the platform's line endings, as text mode did.
+        content = content.replace(b'\n', os.linesep.encode())
     # pp(block)
-    if not block['path']:
+    if not block.path:
         info(Action.UNCHANGED, 'No destination defined', last=False)
-        # error(Action.CHOP, block['source_file'], 'Destination is not defined.')
+        # error(Action.CHOP, block.source_file, 'Destination is not defined.')
         # sys.exit(1)
         return True
 
-    partial_file = Path(os.path.join(block['base_path'], block['path']))
-
-    if partial_file.parent.mkdir(parents=True, exist_ok=True):
-        info(Action.DIR, partial_file.parent)
+    partial_file = block.dest
+    make_dirs(os.path.dirname(partial_file))
 
     try:
-        if warn and not partial_file.exists():
-            info(Action.DOESNOTEXIST, partial_file, last=last)
-            success: bool = False
-
-        elif partial_file.exists():
-            with open(partial_file, 'r+') as f:
-                success: bool = write_to_file(
-                    block, content, f, last, partial_file, warn, False
-                )
+        if warn:
+            if os.path.exists(partial_file):
+                with open(partial_file, 'r+b', buffering=WRITE_BUF) as f:
+                    success: bool = write_to_file(
+                        block, content, f, last, partial_file, warn, dry_run
+                    )
+            else:
+                info(Action.DOESNOTEXIST, partial_file, last=last)
+                success: bool = False
+
         else:
-            with open(partial_file, 'w') as f:
-                success: bool = write_to_file(
-                    block, content, f, last, partial_file, False, True
-                )
+            with WRITE_LOCK:
+                if write_new_file(content, partial_file, last, dry_run):
+                    success: bool = True
+                else:
+                    with open(partial_file, 'r+b', buffering=WRITE_BUF) as f:
+                        success: bool = write_to_file(
+                            block, content, f, last, partial_file, warn, dry_run, touch
+                        )
     except IsADirectoryError:
-        error(Action.CHOP, block['source_file'], 'Destination is a dir.')
+        error(Action.CHOP, block.source_file, 'Destination is a dir.')
         sys.exit(1)
 
     return success
 
 
-def write_to_file(block, content, f, last, partial, warn, newfile):
+def make_dirs(path: str) -> None:
+    """Create the directory and its parents, once per run."""
+    if path and path not in DIRS_MADE:
+        os.makedirs(path, exist_ok=True)
+        DIRS_MADE.add(path)
+
+
+def write_new_file(content: bytes, partial: str, last: bool, dry_run: bool) -> bool:
+    """Create the file with a single open and write.
+
+    The file is opened exclusively so no separate existence check is
+    needed, return False without writing if it already exists."""
+    if dry_run:
+        if os.path.exists(partial):
+            return False
+    else:
+        try:
+            fd = os.open(partial, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        except FileExistsError:
+            return False
+        try:
+            view = memoryview(content)
+            while view:
+                view = view[os.write(fd, view) :]
+        finally:
+            os.close(fd)
+
+    info(Action.NEW, partial, last=last)
+    return True
+
+
+def write_to_file(block, content, f, last, partial, warn, dry_run, touch=False):
     """Write the content to the file if it differs from the current contents.
 
     Show a diff if the file contents differ and the warn flag is set.
+    The file is only read in full if the contents are needed for the diff.
+    An unchanged file's modification time is updated if touch is set.
     """
     success: bool = True
-    try:
-        current_contents = f.read()
-    except io.UnsupportedOperation:
-        current_contents = None
+    changed: bool = not same_text(f, content)
 
-    if current_contents != content:
+    if changed:
         if warn:
             error(Action.WRITE, partial, 'File contents differ')
-            show_diff(content, current_contents, block['path'], str(partial))
+            f.seek(0)
+            show_diff(
+                block.content,
+                universal_newlines(f.read()).decode('utf-8', 'replace'),
+                block.path,
+                str(partial),
+            )
             success = False
-            print()
-            # if not DRYRUN:
+            echo()
+            # if not dry_run:
             #     sys.exit(1)
         else:
-            if newfile:
-                info(Action.NEW, partial, last=last)
-            else:
-                info(Action.WRITE, partial, last=last)
-            if not DRYRUN:
+            info(Action.WRITE, partial, last=last)
+            if not dry_run:
                 f.seek(0)
                 f.write(content)
                 f.truncate()
     else:
         info(Action.UNCHANGED, partial, last=last)
+        if touch and not dry_run:
+            os.utime(partial)
 
     return success
 
 
+def same_text(f: io.BufferedIOBase, content: bytes) -> bool:
+    """Compare the file with content, ignoring line endings as text mode does.
+
+    Files that only differ in their line endings count as the same.  The
+    file is only read in full when a byte for byte compare fails and the
+    size difference could be down to the line endings."""
+    size: int = os.fstat(f.fileno()).st_size
+    if size == len(content) and same_contents(f, content):
+        return True
+    newlines: int = content.count(b'\n')
+    if not len(content) - newlines <= size <= len(content) + newlines:
+        return False
+    f.seek(0)
+    return universal_newlines(f.read()) == universal_newlines(content)
+
+
+def universal_newlines(data: bytes) -> bytes:
+    """Translate CRLF and lone CR line endings to LF."""
+    return data.replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+
+
+def same_contents(f: io.BufferedIOBase, content: bytes) -> bool:
+    """Compare the file with content, stopping at the first chunk that differs."""
+    view = memoryview(content)
+    offset: int = 0
+    while chunk := f.read(CHUNK_SIZE):
+        if view[offset : offset + len(chunk)] != chunk:
+            return False
+        offset += len(chunk)
+    return offset == len(content)
+
+
 def show_diff(a, b, fname_a, fname_b):
+    echo()
+    if max(len(a), len(b)) > MAX_DIFF_SIZE:
+        # difflib's matcher can take minutes on very large files.
+        sizes = f'{len(b)} -> {len(a)} characters'
+        echo(f'{C.BCYAN}Files are too large to diff ({sizes}){C.RESET}')
+        return
+
+    a_lines, b_lines = a.splitlines(), b.splitlines()
+    if a_lines == b_lines:
+        # There are no lines to show, say what differs instead.
+        echo(f'{C.BCYAN}Only the line endings or trailing newline differ{C.RESET}')
+        return
+
     diff = difflib.context_diff(
-        a.splitlines(), b.splitlines(), tofile=fname_a, fromfile=fname_b, n=0
+        a_lines, b_lines, tofile=fname_a, fromfile=fname_b, n=0
     )
-    print()
 
     for i, line in enumerate(diff):
         if i <= 2:
             continue
+        if i > MAX_DIFF_LINES + 2:
+            echo(f'{C.BCYAN}... diff truncated at {MAX_DIFF_LINES} lines{C.RESET}')
+            break
 
         line = line.rstrip()
-
-        if line.startswith('!'):
-            print(line)
-        elif line.startswith('--'):
-            print(f'{C.BLACK}{C.REDB}{line}{C.RESET}')
-        elif line.startswith('****'):
-            hl = '=' * 80
-            print()
-            print(f'{C.BCYAN}{hl}{C.RESET}')
-            print()
-        elif line.startswith('*'):
-            print(f'{C.BLACK}{C.GREENB}{line}{C.RESET}')
-        else:
-            print(line)
+        style = DIFF_STYLES.get(line[:4]) or DIFF_STYLES.get(line[:2], '{}')
+        echo(style.format(line))
 
 
 def main():
@@ -341,6 +773,12 @@ def main():
         action='store_true',
         help='Warn when the file contents differs instead of overwriting it.',
     )
+    parser.add_argument(
+        '--newer',
+        action='store_true',
+        help='Skip chopper files whose destination files are all newer. '
+        'Ignored with --warn.',
+    )
     parser.add_argument(
         '--dry-run',
         action="store_true",
@@ -354,36 +792,54 @@ def main():
 
     args = parser.parse_args()
 
-    global DRYRUN
-    DRYRUN = args.dry_run
-
-    if os.path.exists(args.source_dir):
-        if os.path.isdir(args.source_dir):
-            chopper_files = find_chopper_files(args.source_dir)
-        else:
-            chopper_files = [args.source_dir]
-    else:
+    try:
+        source_mode: int = os.stat(args.source_dir).st_mode
+    except OSError:
         error(Action.CHOP, args.source_dir, 'No such file or directory:')
         sys.exit(1)
 
+    if stat.S_ISDIR(source_mode):
+        chopper_files = find_chopper_files(args.source_dir)
+    else:
+        chopper_files = [args.source_dir]
+
     types = {
-        'script': args.script_dir or '',
-        'style': args.style_dir or '',
-        'chop': args.html_dir or '',
+        'script': dir_prefix(args.script_dir),
+        'style': dir_prefix(args.style_dir),
+        'chop': dir_prefix(args.html_dir),
     }
 
     comment_types = {
-        'script': ['// ', ''],
-        'style': ['/* ', ' */'],
-        # 'chop': ['<!-- ', ' -->'],
-        'chop': ['{{# ', ' #}}'],
+        'script': ('// ', ''),
+        'style': ('/* ', ' */'),
+        # 'chop': ('<!-- ', ' -->'),
+        'chop': ('{{# ', ' #}}'),
     }
 
     success: bool = True
-    for source in chopper_files:
-        if not chop(source, types, args.comments, comment_types, warn=args.warn):
+    chop_file = partial(
+        buffered_chop,
+        types=types,
+        insert_comments=args.comments,
+        comments=comment_types,
+        warn=args.warn,
+        newer=args.newer,
+        dry_run=args.dry_run,
+    )
+    failure = None
+    # A file that exits or fails stops the files after it.  Those already
+    # being chopped are still reported before the failure is raised.
+    results = map_sources(chop_file, chopper_files, stop=itemgetter(2))
+    for result, output, exc in results:
+        write_output(output)
+        if failure is None:
+            failure = exc
+        if not result:
             success = False
 
+    if failure is not None:
+        raise failure
+
     if not success:
         error(Action.CHOP, '', 'Some files were different.')
         sys.exit(1)
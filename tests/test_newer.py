@@ -0,0 +1,132 @@
+"""--newer skips chopper files whose destinations are all newer than them."""
+
+import os
+import sys
+
+import pytest
+
+from chopper import chopper
+
+SOURCE = '''
+<style chopper:file="a.css">
+  a {}
+</style>
+<script chopper:file="a.js">
+  a();
+</script>
+'''
+OLD = 1_000_000
+NOW = 2_000_000
+NEW = 3_000_000
+
+
+@pytest.fixture
+def source(tmp_path):
+    source = tmp_path / 'src' / 'a.chopper.html'
+    source.parent.mkdir()
+    source.write_text(SOURCE)
+    os.utime(source, (NOW, NOW))
+    return source
+
+
+def dest(tmp_path, path: str, mtime: int, text: str = 'stale\n'):
+    """Create a destination file with the given modification time."""
+    dest = tmp_path / path
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    dest.write_text(text)
+    os.utime(dest, (mtime, mtime))
+    return dest
+
+
+def run(monkeypatch, tmp_path, source, *args) -> int:
+    """Run chopper on the source and return its exit status."""
+    argv = [
+        'chopper',
+        *args,
+        f'--script={tmp_path / "js"}',
+        f'--style={tmp_path / "css"}',
+        f'--html={tmp_path / "html"}',
+        str(source),
+    ]
+    monkeypatch.setattr(sys, 'argv', argv)
+    try:
+        chopper.main()
+    except SystemExit as e:
+        return e.code
+    return 0
+
+
+def types(tmp_path) -> dict:
+    return {
+        'script': chopper.dir_prefix(str(tmp_path / 'js')),
+        'style': chopper.dir_prefix(str(tmp_path / 'css')),
+        'chop': chopper.dir_prefix(str(tmp_path / 'html')),
+    }
+
+
+def test_missing_destination(monkeypatch, capsys, tmp_path, source):
+    css = dest(tmp_path, 'css/a.css', NEW)
+    assert not chopper.is_up_to_date(str(source), types(tmp_path))
+
+    assert run(monkeypatch, tmp_path, source, '--newer') == 0
+    assert 'Up to date' not in capsys.readouterr().out
+    assert (tmp_path / 'js' / 'a.js').read_text() == 'a();\n'
+    assert css.read_text() == 'a {}\n'
+
+
+def test_older_destination(monkeypatch, capsys, tmp_path, source):
+    css = dest(tmp_path, 'css/a.css', NEW)
+    js = dest(tmp_path, 'js/a.js', OLD)
+    assert not chopper.is_up_to_date(str(source), types(tmp_path))
+
+    assert run(monkeypatch, tmp_path, source, '--newer') == 0
+    assert 'Up to date' not in capsys.readouterr().out
+    assert js.read_text() == 'a();\n'
+    assert css.read_text() == 'a {}\n'
+
+
+def test_all_destinations_newer(monkeypatch, capsys, tmp_path, source):
+    css = dest(tmp_path, 'css/a.css', NEW)
+    js = dest(tmp_path, 'js/a.js', NEW)
+    assert chopper.is_up_to_date(str(source), types(tmp_path))
+
+    assert run(monkeypatch, tmp_path, source, '--newer') == 0
+    assert 'Up to date' in capsys.readouterr().out
+    assert js.read_text() == 'stale\n'
+    assert css.read_text() == 'stale\n'
+
+
+def test_block_without_destination_is_ignored(tmp_path, source):
+    source.write_text(SOURCE + '<chop>\n  no destination\n</chop>\n')
+    os.utime(source, (NOW, NOW))
+    dest(tmp_path, 'css/a.css', NEW)
+    dest(tmp_path, 'js/a.js', NEW)
+    assert chopper.is_up_to_date(str(source), types(tmp_path))
+
+
+def test_warn_ignores_newer(monkeypatch, capsys, tmp_path, source):
+    css = dest(tmp_path, 'css/a.css', NEW)
+    dest(tmp_path, 'js/a.js', NEW)
+
+    assert run(monkeypatch, tmp_path, source, '--warn', '--newer') == 1
+    captured = capsys.readouterr()
+    assert 'Up to date' not in captured.out
+    assert 'File contents differ' in captured.err
+    assert css.read_text() == 'stale\n'
+
+
+def test_unchanged_destinations_are_touched(monkeypatch, capsys, tmp_path, source):
+    assert run(monkeypatch, tmp_path, source) == 0
+    css = tmp_path / 'css' / 'a.css'
+    os.utime(css, (OLD, OLD))
+
+    # Only the script block is edited, a.css compares unchanged.
+    source.write_text(SOURCE.replace('a();', 'b();'))
+    os.utime(source, (NOW, NOW))
+    assert run(monkeypatch, tmp_path, source, '--newer') == 0
+    assert 'File unchanged' in capsys.readouterr().out
+    assert css.stat().st_mtime > NOW
+    assert chopper.is_up_to_date(str(source), types(tmp_path))
+
+    assert run(monkeypatch, tmp_path, source, '--newer') == 0
+    assert 'Up to date' in capsys.readouterr().out
@@ -0,0 +1,201 @@
+"""ChopperParser's regex scan, checked against what the html.parser based
+parser it replaced found in the same sources."""
+
+import time
+
+from chopper import chopper
+
+
+def blocks(source: bytes) -> list:
+    """Parse the source and return each block's tag, path and content."""
+    parser = chopper.ChopperParser()
+    parser.parse(source)
+    return [
+        (
+            block.tag,
+            block.path,
+            chopper.extract_block(block.start, block.end, source)
+            if block.path
+            else None,
+        )
+        for block in parser.parsed_data
+    ]
+
+
+def test_blocks():
+    source = b'''
+<style chopper:file="a.css">
+  a { color: red; }
+</style>
+<p>not a block</p>
+<script chopper:file="a.js">
+  a();
+</script>
+'''
+    assert blocks(source) == [
+        ('style', 'a.css', 'a { color: red; }\n'),
+        ('script', 'a.js', 'a();\n'),
+    ]
+
+
+def test_tags_in_comments_are_ignored():
+    source = b'''
+<!-- <chop chopper:file="no.twig">no</chop> -->
+<chop chopper:file="yes.twig">
+  <!-- </chop> -->
+  yes
+</chop>
+'''
+    assert blocks(source) == [('chop', 'yes.twig', '<!-- </chop> -->\nyes\n')]
+
+
+def test_script_and_style_are_raw_text():
+    source = b'''
+<script chopper:file="a.js">
+  if (a < b) { s = '<chop chopper:file="no.twig"></chop>'; }
+</script>
+<style chopper:file="a.css">
+  p::before { content: "</chop><style>"; }
+</style>
+'''
+    script = 'if (a < b) { s = \'<chop chopper:file="no.twig"></chop>\'; }\n'
+    assert blocks(source) == [
+        ('script', 'a.js', script),
+        ('style', 'a.css', 'p::before { content: "</chop><style>"; }\n'),
+    ]
+
+
+def test_nested_chop_tags_stay_in_the_outer_block():
+    source = b'''
+<chop chopper:file="outer.twig">
+  <div>
+    <chop>inner</chop>
+  </div>
+</chop>
+<chop chopper:file="after.twig">
+  after
+</chop>
+'''
+    assert blocks(source) == [
+        ('chop', 'outer.twig', '<div>\n  <chop>inner</chop>\n</div>\n'),
+        ('chop', 'after.twig', 'after\n'),
+    ]
+
+
+def test_self_closing_tags():
+    source = b'''
+<style chopper:file="a.css">
+  a {}
+</style>
+<script src="vendor.js" />
+<chop chopper:file="b.twig">
+  b
+</chop>
+<chop/>
+<script chopper:file="c.js">
+  c();
+</script>
+'''
+    assert blocks(source) == [
+        ('style', 'a.css', 'a {}\n'),
+        ('script', '', None),
+        ('chop', 'b.twig', 'b\n'),
+        ('chop', '', None),
+        ('script', 'c.js', 'c();\n'),
+    ]
+
+
+def test_gt_in_quoted_attribute_values():
+    source = b'''
+<chop data-a="a > b" data-b='<c>' chopper:file="gt.twig">
+  gt
+</chop>
+'''
+    assert blocks(source) == [('chop', 'gt.twig', 'gt\n')]
+
+
+def test_chopper_file_is_matched_as_an_attribute_name():
+    source = b'''
+<chop title="see chopper:file=zzz" chopper:file="b.twig">
+  b
+</chop>
+<chop data-chopper:file="no.twig" chopper:file="first.twig" chopper:file=last.twig>
+  last
+</chop>
+'''
+    assert blocks(source) == [
+        ('chop', 'b.twig', 'b\n'),
+        ('chop', 'last.twig', 'last\n'),
+    ]
+
+
+def test_quotes_only_start_a_value_after_equals():
+    source = b'''
+<chop chopper:file="a.html" title=it's>
+  a
+</chop>
+<chop title=a<b data-x='y' chopper:file = "b.twig">
+  b
+</chop>
+'''
+    assert blocks(source) == [
+        ('chop', 'a.html', 'a\n'),
+        ('chop', 'b.twig', 'b\n'),
+    ]
+
+
+def test_unterminated_tags():
+    source = b'''
+<chop chopper:file="a.twig">
+  a
+</chop>
+<chop title='never closed>
+<chop chopper:file="no.twig">no</chop>
+'''
+    assert blocks(source) == [('chop', 'a.twig', 'a\n')]
+    assert blocks(b'<!-- <chop chopper:file="no.twig">no</chop>') == []
+
+
+def test_unterminated_start_tags_are_scanned_once():
+    source = b'<chop chopper:file="a.twig">a</chop>' + b'<chop a=' * 20_000
+    start = time.perf_counter()
+    assert blocks(source) == [('chop', 'a.twig', 'a\n')]
+    # Rescanning the rest of the data for every tag takes minutes here.
+    assert time.perf_counter() - start < 1
+
+
+def test_entities_in_paths_are_unescaped():
+    source = b'''
+<chop chopper:file="a&amp;b&#46;twig">
+  &amp; stays escaped in the content
+</chop>
+'''
+    assert blocks(source) == [
+        ('chop', 'a&b.twig', '&amp; stays escaped in the content\n')
+    ]
+
+
+def test_upper_case_tags_and_attributes():
+    source = b'''
+<STYLE CHOPPER:FILE="up.css">
+  a {}
+</Style>
+<Chop Chopper:File="up.twig">
+  <CHOP>inner</CHOP>
+</CHOP>
+'''
+    assert blocks(source) == [
+        ('style', 'up.css', 'a {}\n'),
+        ('chop', 'up.twig', '<CHOP>inner</CHOP>\n'),
+    ]
+
+
+def test_crlf_line_endings():
+    source = (
+        b'<style chopper:file="crlf.css">\r\n'
+        b'  a {}\r\n'
+        b'\r\n'
+        b'  b {}\r\n'
+        b'</style>\r\n'
+    )
+    assert blocks(source) == [('style', 'crlf.css', 'a {}\n\nb {}\n')]
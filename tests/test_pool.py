@@ -0,0 +1,47 @@
+"""Chopping several files in worker processes, and stopping at a failure."""
+
+import sys
+
+from chopper import chopper
+
+OK = '''
+<style chopper:file="{name}.css">
+  a {{}}
+</style>
+'''
+BAD = '<style chopper:file="{BAD}.css">\n  a {}\n</style>\n'
+
+
+def test_files_after_a_failure_are_not_chopped(monkeypatch, capsys, tmp_path):
+    src = tmp_path / 'src'
+    out = tmp_path / 'out'
+    src.mkdir()
+    (src / 'a_bad.chopper.html').write_text(BAD)
+    names = [f'ok{i:02}' for i in range(20)]
+    for name in names:
+        (src / f'{name}.chopper.html').write_text(OK.format(name=name))
+
+    # Chop in a known order, the failing file first.  With two workers at
+    # most four files are handed to the pool before its result is seen.
+    monkeypatch.setattr(chopper, 'MAX_WORKERS', 2)
+    monkeypatch.setattr(
+        chopper, 'find_chopper_files', lambda source: sorted(map(str, src.iterdir()))
+    )
+    argv = ['chopper', f'--script={out}', f'--style={out}', f'--html={out}', str(src)]
+    monkeypatch.setattr(sys, 'argv', argv)
+    code = 0
+    try:
+        chopper.main()
+    except SystemExit as e:
+        code = e.code
+    captured = capsys.readouterr()
+
+    assert code == 1
+    assert 'Invalid magic variable in attribute:' in captured.err
+    assert 'a_bad.chopper.html' in captured.err
+
+    written = sorted(path.stem for path in out.iterdir()) if out.exists() else []
+    assert set(written) <= set(names[:3])
+    # Files that were already running are reported, the rest never start.
+    for name in names:
+        assert (f'{name}.chopper.html' in captured.out) == (name in written)
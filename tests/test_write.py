@@ -0,0 +1,73 @@
+"""Destinations are compared the way the text mode files they replaced
+were, so their line endings don't count as a change."""
+
+import sys
+
+import pytest
+
+from chopper import chopper
+
+SOURCE = '''
+<style chopper:file="a.css">
+  a {}
+
+  b {}
+</style>
+'''
+
+
+@pytest.fixture
+def source(tmp_path):
+    source = tmp_path / 'a.chopper.html'
+    source.write_text(SOURCE)
+    return source
+
+
+def run(monkeypatch, tmp_path, source, *args) -> int:
+    """Run chopper on the source and return its exit status."""
+    out = tmp_path / 'out'
+    argv = ['chopper', *args, f'--script={out}', f'--style={out}', f'--html={out}']
+    monkeypatch.setattr(sys, 'argv', [*argv, str(source)])
+    try:
+        chopper.main()
+    except SystemExit as e:
+        return e.code
+    return 0
+
+
+@pytest.mark.parametrize('newline', [b'\r\n', b'\r'])
+def test_line_endings_are_not_a_change(monkeypatch, capsys, tmp_path, source, newline):
+    css = tmp_path / 'out' / 'a.css'
+    css.parent.mkdir()
+    css.write_bytes(b'a {}\n\nb {}\n'.replace(b'\n', newline))
+
+    assert run(monkeypatch, tmp_path, source) == 0
+    assert 'File unchanged' in capsys.readouterr().out
+    assert css.read_bytes() == b'a {}\n\nb {}\n'.replace(b'\n', newline)
+
+    assert run(monkeypatch, tmp_path, source, '--warn') == 0
+    assert 'File contents differ' not in capsys.readouterr().err
+
+
+def test_changed_crlf_destination(monkeypatch, capsys, tmp_path, source):
+    css = tmp_path / 'out' / 'a.css'
+    css.parent.mkdir()
+    css.write_bytes(b'a {}\r\nb {}\r\n')
+
+    assert run(monkeypatch, tmp_path, source, '--warn') == 1
+    assert 'File contents differ' in capsys.readouterr().err
+
+    assert run(monkeypatch, tmp_path, source) == 0
+    assert 'Write' in capsys.readouterr().out
+    assert css.read_bytes() == b'a {}\n\nb {}\n'
+
+
+def test_missing_trailing_newline(monkeypatch, capsys, tmp_path, source):
+    css = tmp_path / 'out' / 'a.css'
+    css.parent.mkdir()
+    css.write_bytes(b'a {}\n\nb {}')
+
+    assert run(monkeypatch, tmp_path, source, '--warn') == 1
+    captured = capsys.readouterr()
+    assert 'File contents differ' in captured.err
+    assert 'Only the line endings or trailing newline differ' in captured.out